@@ -2,23 +2,60 @@
 
 """Retrieves information on 510(k) medical devices from the FDA database and stores it in a Microsoft Excel file"""
 
+import csv  # For writing change sets to CSV files
 import datetime
+import gzip  # For compressing snapshots when neither zstd nor lz4 is installed
+import hashlib  # For hashing records in snapshots
+import json  # For storing snapshots
+import logging  # For reporting compression when not using the GUI
+import os
+import time  # For measuring the CPU cost of compression
 import tkinter  # For a simple GUI
 import threading  # For threading queries
 
 import openpyxl  # For writing to MS Excel
 import requests  # For making HTTPS requests
 
+# Optional compression libraries. Snapshots are compressed with the fastest codec that is installed.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
 # Base endpoint for API calls to 510(k) API
 BASE_URL_510k = "https://api.fda.gov/device/510k.json"
 
+# Base endpoints for the related openFDA device APIs
+BASE_URL_CLASSIFICATION = "https://api.fda.gov/device/classification.json"
+BASE_URL_PMA = "https://api.fda.gov/device/pma.json"
+BASE_URL_RECALL = "https://api.fda.gov/device/recall.json"
+
 # 510(k) Dictionary Keys
 RESULTS_DICT_KEY = "results"  # "results" is a list of dictionaries
+META_DICT_KEY = "meta"  # "meta" holds information about the query, such as the total number of matches
+TOTAL_DICT_KEY = "total"  # total number of records matching the query, found in meta["results"]
 
 # 510(k) Query Params
 SEARCH_QUERY_KEY = "search"  # specifies which fields to search
 LIMIT_QUERY_KEY = "limit"  # specifies how many results to return
+SKIP_QUERY_KEY = "skip"  # specifies how many results to skip, used for pagination
 MAX_QUERY_SIZE = 99  # maximum number of results that a query can return
+MAX_BULK_QUERY_SIZE = 1000  # maximum number of results that openFDA returns per page
+MAX_QUERY_SKIP = 25000  # openFDA rejects skip values larger than this
+BULK_QUERY_CHUNK_SIZE = 50  # number of values to OR together in one bulk search, to keep the URL short
+
+# HTTP status code that openFDA responds with when nothing matches a search
+NOT_FOUND_STATUS_CODE = 404
+
+# HTTP headers for compressed transfer encoding. requests already asks for every encoding that it can decode.
+ACCEPT_ENCODING_HEADER = "Accept-Encoding"
+CONTENT_ENCODING_HEADER = "Content-Encoding"
+IDENTITY_ENCODING = "identity"  # the Content-Encoding of an uncompressed response
 
 # 510(k) Query syntax characters
 QUERY_FIELD_COLON = ":"
@@ -35,13 +72,58 @@ STATE_KEY = "state"
 DATE_RECEIVED_KEY = "date_received"
 DECISION_CODE_KEY = "decision_code"
 DECISION_DATE_KEY = "decision_date"
+DECISION_DESCRIPTION_KEY = "decision_description"
 
 DEVICE_NAME_KEY = "device_name"
 K_NUMBER_KEY = "k_number"
+PRODUCT_CODE_KEY = "product_code"
+
+# Device classification "results" dictionary record attributes
+DEVICE_CLASS_KEY = "device_class"
+REGULATION_NUMBER_KEY = "regulation_number"
+MEDICAL_SPECIALTY_KEY = "medical_specialty_description"
+
+# PMA "results" dictionary record attributes
+PMA_NUMBER_KEY = "pma_number"
+SUPPLEMENT_NUMBER_KEY = "supplement_number"
+TRADE_NAME_KEY = "trade_name"
+
+# Recall "results" dictionary record attributes
+RECALL_EVENT_NUMBER_KEY = "res_event_number"
+RECALL_STATUS_KEY = "recall_status"
+RECALL_INITIATED_DATE_KEY = "event_date_initiated"
+RECALL_REASON_KEY = "reason_for_recall"
+RECALL_K_NUMBERS_KEY = "k_numbers"  # list of the 510(k) numbers that a recall applies to
+
+# Attributes added to a 510(k) record when it is enriched with related records
+PMA_NUMBERS_KEY = "pma_numbers"
+RECALL_COUNT_KEY = "recall_count"
+RECALL_EVENT_NUMBERS_KEY = "recall_event_numbers"
+
+# Snapshot and change set attributes
+CHANGE_TYPE_KEY = "change_type"
+CHANGE_TYPE_INSERTED = "inserted"
+CHANGE_TYPE_UPDATED = "updated"
+CHANGE_TYPE_REMOVED = "removed"
+SNAPSHOT_HASH_LENGTH = 16  # number of hex digits of each record's SHA-256 hash to keep in a snapshot
+SNAPSHOT_VERSION_KEY = "version"
+SNAPSHOT_VERSION = 2  # version 1 stored a bare hash per k_number; version 2 stores [hash, decision date]
+SNAPSHOT_ENTRIES_KEY = "entries"
+
+# Snapshot compression codecs, and the magic bytes that each codec's output starts with
+ZSTD_CODEC = "zstd"
+LZ4_CODEC = "lz4"
+GZIP_CODEC = "gzip"
+ZSTD_MAGIC_BYTES = b"\x28\xb5\x2f\xfd"
+LZ4_MAGIC_BYTES = b"\x04\x22\x4d\x18"
+GZIP_MAGIC_BYTES = b"\x1f\x8b"
+ZSTD_COMPRESSION_LEVEL = 3
+GZIP_COMPRESSION_LEVEL = 1  # favour speed, since gzip is only the fallback codec
 
 # Constants for Strings
 EMPTY_STR = ""
 EQUALS_STR = "="
+JOINED_VALUES_SEPARATOR = ", "
 
 # User input constants
 DATE_FORMAT_UI = "YYYY-MM-DD"
@@ -51,33 +133,155 @@ DATE_STR_TO_DATE_TIME_FORMAT = "%Y-%m-%d"
 EXCEL_FILE_FORMAT = ".xlsx"
 EXCEL_SHEET_NAME = "510(k)"
 
+# Snapshot and CSV files
+SNAPSHOT_FILE_FORMAT = ".snapshot"
+CSV_FILE_FORMAT = ".csv"  # results can be saved to a CSV file instead of an Excel file
+
 # tkinter GUI
 TO_DECISION_DATE_LBL_TEXT = "To Decision Date (" + DATE_FORMAT_UI + ")"
 FROM_DECISION_DATE_LBL_TEXT = "From Decision Date (" + DATE_FORMAT_UI + ")"
-EXCEL_FILE_LBL_TEXT = "Name of MS Excel file to save results in (must be a .xlsx file)"
+EXCEL_FILE_LBL_TEXT = "Name of MS Excel or CSV file to save results in (must be a .xlsx or .csv file)"
+SNAPSHOT_FILE_LBL_TEXT = "Name of snapshot file to save only changes since its last run " \
+                         "(optional, must be a .snapshot file)"
 RUN_QUERY_BTN_TEXT = "Get 510(k) medical device data"
+ENRICH_RECORDS_CHK_TEXT = "Add classification, PMA, and recall data"
 
 QUERY_STATUS_LBL_TEXT = "Query status: "
 QUERY_STATUS_RUNNING_TEXT = "Getting data ..."
-QUERY_STATUS_FINISHED_TEXT = "Finished getting data. Check your current folder/directory for the Excel file"
+QUERY_STATUS_FINISHED_TEXT = "Finished getting data. Check your current folder/directory for the results file"
+QUERY_STATUS_FAILED_TEXT = "Failed to get data: "
 
 INVALID_TO_DATE_MSG = "The 'to' date is invalid."
 INVALID_FROM_DATE_MSG = "The 'from' date is invalid."
 INVALID_DATE_RANGE_MSG = "The date range is invalid."
-INVALID_EXCEL_FILE_PATH_MSG = "The MS Excel file path is invalid."
+INVALID_OUTPUT_FILE_PATH_MSG = "The results file path is invalid."
+INVALID_SNAPSHOT_FILE_PATH_MSG = "The snapshot file path is invalid."
 
 # tkinter event-handling
 WM_DELETE_WINDOW_EVENT_STR = "WM_DELETE_WINDOW"
 
+# Number of bytes in a kilobyte, for reporting sizes
+BYTES_PER_KB = 1024
+
 # Global variables for program execution
 window = None
 to_decision_date_ent = None
 from_decision_date_ent = None
 excel_file_ent = None
+snapshot_file_ent = None
 query_status_lbl = None
 run_query_btn = None
+enrich_records_var = None
 USING_GUI = False
 
+# Reports compression savings to callers that do not use the GUI, e.g. headless backfills
+logger = logging.getLogger(__name__)
+
+# Reuse one HTTP session for every request so that connections are kept alive
+session = requests.Session()
+
+
+class QueryTooLargeError(ValueError):
+    """
+    Raised when a search matches more records than openFDA lets us page through
+    """
+
+
+class OpenFdaEndpointSchema:
+    """
+    Describes an openFDA device endpoint: where to query it and which attributes to extract from its records
+    """
+
+    def __init__(self, name, base_url, record_keys):
+        self.name = name
+        self.base_url = base_url
+        self.record_keys = record_keys
+
+
+SCHEMA_510k = OpenFdaEndpointSchema("510(k)", BASE_URL_510k, [
+    # Info about applicant, location
+    ADDRESS_1__KEY, APPLICANT_KEY, CONTACT_KEY, COUNTRY_CODE_KEY, STATE_KEY,
+
+    # Info about approval process
+    DATE_RECEIVED_KEY, DECISION_DATE_KEY, DECISION_CODE_KEY, DECISION_DESCRIPTION_KEY,
+
+    # Info about device
+    DEVICE_NAME_KEY, K_NUMBER_KEY, PRODUCT_CODE_KEY,
+])
+
+SCHEMA_CLASSIFICATION = OpenFdaEndpointSchema("classification", BASE_URL_CLASSIFICATION, [
+    PRODUCT_CODE_KEY, DEVICE_NAME_KEY, DEVICE_CLASS_KEY, REGULATION_NUMBER_KEY, MEDICAL_SPECIALTY_KEY,
+])
+
+SCHEMA_PMA = OpenFdaEndpointSchema("PMA", BASE_URL_PMA, [
+    PMA_NUMBER_KEY, SUPPLEMENT_NUMBER_KEY, PRODUCT_CODE_KEY, TRADE_NAME_KEY, APPLICANT_KEY, DECISION_DATE_KEY,
+])
+
+SCHEMA_RECALL = OpenFdaEndpointSchema("recall", BASE_URL_RECALL, [
+    RECALL_EVENT_NUMBER_KEY, PRODUCT_CODE_KEY, RECALL_K_NUMBERS_KEY, RECALL_STATUS_KEY, RECALL_INITIATED_DATE_KEY,
+    RECALL_REASON_KEY,
+])
+
+
+class CompressionStats:
+    """
+    Tracks how many bytes compression saved, on the wire and on disk, and how much CPU time compression cost
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        self.response_encodings = {}
+        self.uncompressed_responses = 0
+        self.decode_cpu_seconds = 0.0
+        self.stored_bytes = 0
+        self.raw_stored_bytes = 0
+        self.codec_cpu_seconds = 0.0
+
+    def add_response(self, response, decode_cpu_seconds):
+        # Count the responses by the encoding that the server actually used, so that uncompressed responses show up
+        encoding = response.headers.get(CONTENT_ENCODING_HEADER, IDENTITY_ENCODING)
+        self.response_encodings[encoding] = self.response_encodings.get(encoding, 0) + 1
+
+        # Flag the responses that came back uncompressed even though the request asked for compression
+        if encoding == IDENTITY_ENCODING and response.request.headers.get(ACCEPT_ENCODING_HEADER):
+            self.uncompressed_responses += 1
+
+        # requests decodes the content transparently, but the raw response still knows how many bytes it read
+        decoded_bytes = len(response.content)
+        tell = getattr(response.raw, "tell", None)
+        self.wire_bytes += tell() if tell else decoded_bytes
+        self.decoded_bytes += decoded_bytes
+        self.decode_cpu_seconds += decode_cpu_seconds
+
+    def add_stored(self, raw_bytes, stored_bytes, cpu_seconds):
+        self.raw_stored_bytes += raw_bytes
+        self.stored_bytes += stored_bytes
+        self.codec_cpu_seconds += cpu_seconds
+
+    def add_loaded(self, cpu_seconds):
+        self.codec_cpu_seconds += cpu_seconds
+
+    def get_report(self):
+        encodings = ", ".join("%s: %d" % (k, v) for k, v in sorted(self.response_encodings.items()))
+        report = "Downloaded %.1f KB (%.1f KB decoded in %.1f ms CPU; responses by encoding: %s)." % (
+            self.wire_bytes / BYTES_PER_KB, self.decoded_bytes / BYTES_PER_KB, self.decode_cpu_seconds * 1000,
+            encodings or "none")
+        if self.uncompressed_responses:
+            report += " Responses not compressed even though compression was negotiated: %d." % \
+                      self.uncompressed_responses
+        if self.raw_stored_bytes:
+            report += " Stored %.1f KB (%.1f KB uncompressed) with %s; compressing and decompressing took %.1f ms " \
+                      "CPU." % (self.stored_bytes / BYTES_PER_KB, self.raw_stored_bytes / BYTES_PER_KB,
+                                get_snapshot_codec(), self.codec_cpu_seconds * 1000)
+        return report
+
+
+compression_stats = CompressionStats()
+
 
 class SearchQueryBuilder510k:
     """
@@ -122,36 +326,316 @@ def get_previous_day_from_datetime(current_datetime):
     return current_datetime - datetime.timedelta(days=1)
 
 
-def extract_device_records_from_response(response):
+def get_url_from_params(base_url, params):
+    # Convert the "params" to a string for the GET request
+    # This is done because the requests module converts square brackets [] into percent encodings, which
+    # the openFDA API does not understand.
+    return base_url + "?" + get_string_from_params(params)
+
+
+def get_response(url):
+    # Stream the response so that reading its content, which is when requests decodes it, can be timed
+    response = session.get(url, stream=True)
+    start_time = time.process_time()
+    response.content
+    compression_stats.add_response(response, time.process_time() - start_time)
+    return response
+
+
+def extract_records_from_json(response_json, schema):
     # Get the list of records that matched the GET
-    results = response.json()[RESULTS_DICT_KEY]
+    results = response_json[RESULTS_DICT_KEY]
 
-    # Add each record to our list of records
+    # Keep only the attributes listed in the schema. Not every record has every attribute, so missing ones are empty.
     records = []
     for result in results:
-        record = {
-            # Info about applicant, location
-            ADDRESS_1__KEY: result[ADDRESS_1__KEY],
-            APPLICANT_KEY: result[APPLICANT_KEY],
-            CONTACT_KEY: result[CONTACT_KEY],
-            COUNTRY_CODE_KEY: result[COUNTRY_CODE_KEY],
-            STATE_KEY: result[STATE_KEY],
-
-            # Info about approval process
-            DATE_RECEIVED_KEY: result[DATE_RECEIVED_KEY],
-            DECISION_DATE_KEY: result[DECISION_DATE_KEY],
-            DECISION_CODE_KEY: result[DECISION_CODE_KEY],
-            DECISION_DESCRIPTION_FIELD: result[DECISION_DESCRIPTION_FIELD],
-
-            # Info about device
-            DEVICE_NAME_KEY: result[DEVICE_NAME_KEY],
-            K_NUMBER_KEY: result[K_NUMBER_KEY],
+        record = {key: result.get(key, EMPTY_STR) for key in schema.record_keys}
+        records.append(record)
+    return records
+
+
+def extract_records_from_response(response, schema):
+    return extract_records_from_json(response.json(), schema)
+
+
+def extract_device_records_from_response(response):
+    return extract_records_from_response(response, SCHEMA_510k)
+
+
+def get_total_from_json(response_json):
+    return response_json[META_DICT_KEY][RESULTS_DICT_KEY][TOTAL_DICT_KEY]
+
+
+def get_total_from_response(response):
+    return get_total_from_json(response.json())
+
+
+def fetch_records(schema, search_query_str, page_size=MAX_QUERY_SIZE):
+    records = []
+    skip = 0
+
+    # openFDA will not skip past MAX_QUERY_SKIP, so this is the most records that paging can retrieve
+    max_pageable_total = MAX_QUERY_SKIP + page_size
+
+    # Page through the results until every matching record has been retrieved
+    while skip <= MAX_QUERY_SKIP:
+        params = {
+            SEARCH_QUERY_KEY: search_query_str,
+            LIMIT_QUERY_KEY: page_size,
+            SKIP_QUERY_KEY: skip,
         }
+        response = get_response(get_url_from_params(schema.base_url, params))
 
-        records.append(record)
+        # openFDA responds with a 404 when nothing matches the search. Any other error, such as a rate limit, would
+        # leave the results incomplete, so it is raised instead of being treated as "no matches".
+        if response.status_code == NOT_FOUND_STATUS_CODE:
+            break
+        response.raise_for_status()
+
+        # Parse each page once, since the records and the total both come from it
+        response_json = response.json()
+        total = get_total_from_json(response_json)
+        if total > max_pageable_total:
+            raise QueryTooLargeError(f"The {schema.name} search matches {total} records, but only "
+                                     f"{max_pageable_total} can be retrieved: {search_query_str}")
+
+        page = extract_records_from_json(response_json, schema)
+        records.extend(page)
+
+        skip += page_size
+        if not page or skip >= total:
+            break
+
+    return records
+
+
+def build_search_query_for_values(query_field_name, query_field_values):
+    # OR together every value so that a single search matches all of them
+    query_builder = SearchQueryBuilder510k()
+    query_builder.add_first_query_field(query_field_name, query_field_values[0])
+    for query_field_value in query_field_values[1:]:
+        query_builder.add_query_field(query_field_name, query_field_value, LOGICAL_OR_510k)
+    return query_builder.get_search_query_string()
+
+
+def fetch_records_for_values(schema, query_field_name, query_field_values):
+    search_query_str = build_search_query_for_values(query_field_name, query_field_values)
+    try:
+        return fetch_records(schema, search_query_str, MAX_BULK_QUERY_SIZE)
+    except QueryTooLargeError:
+        # A single value that matches too many records cannot be split any further
+        if len(query_field_values) == 1:
+            raise
+
+        # Split the values in half so that each search matches fewer records
+        middle = len(query_field_values) // 2
+        return fetch_records_for_values(schema, query_field_name, query_field_values[:middle]) + \
+            fetch_records_for_values(schema, query_field_name, query_field_values[middle:])
+
+
+def bulk_fetch_records(schema, query_field_name, query_field_values, chunk_size=BULK_QUERY_CHUNK_SIZE):
+    # Fetch the records matching any of the values, a chunk of values per search instead of one search per value
+    values = sorted(set(value for value in query_field_values if value))
+    records = []
+    for i in range(0, len(values), chunk_size):
+        records.extend(fetch_records_for_values(schema, query_field_name, values[i:i + chunk_size]))
     return records
 
 
+def build_hash_index(records, key):
+    # Map each value of the key to the records that have it. A record whose value is a list is indexed under
+    # every value in the list.
+    index = {}
+    for record in records:
+        values = record.get(key, EMPTY_STR)
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            if value:
+                index.setdefault(value, []).append(record)
+    return index
+
+
+def join_values(records, key):
+    # Join the distinct values of the key, in order of first appearance, into one cell-friendly string
+    values = []
+    for record in records:
+        if record[key] and record[key] not in values:
+            values.append(record[key])
+    return JOINED_VALUES_SEPARATOR.join(values)
+
+
+def join_related_records(devices_info, classification_index, pma_index, recall_index):
+    for info in devices_info:
+        product_code = info.get(PRODUCT_CODE_KEY, EMPTY_STR)
+
+        # A product code has a single classification
+        classifications = classification_index.get(product_code, [])
+        classification = classifications[0] if classifications else {}
+        info[DEVICE_CLASS_KEY] = classification.get(DEVICE_CLASS_KEY, EMPTY_STR)
+        info[REGULATION_NUMBER_KEY] = classification.get(REGULATION_NUMBER_KEY, EMPTY_STR)
+        info[MEDICAL_SPECIALTY_KEY] = classification.get(MEDICAL_SPECIALTY_KEY, EMPTY_STR)
+
+        # PMAs share the product code of the device; recalls list the 510(k) numbers they apply to
+        info[PMA_NUMBERS_KEY] = join_values(pma_index.get(product_code, []), PMA_NUMBER_KEY)
+        recalls = recall_index.get(info[K_NUMBER_KEY], [])
+        info[RECALL_COUNT_KEY] = len(set(recall[RECALL_EVENT_NUMBER_KEY] for recall in recalls))
+        info[RECALL_EVENT_NUMBERS_KEY] = join_values(recalls, RECALL_EVENT_NUMBER_KEY)
+
+    return devices_info
+
+
+def enrich_device_records(devices_info):
+    product_codes = [info.get(PRODUCT_CODE_KEY, EMPTY_STR) for info in devices_info]
+    k_numbers = [info[K_NUMBER_KEY] for info in devices_info]
+
+    # Bulk-load the related records, then join them to the 510(k) records locally
+    classifications = bulk_fetch_records(SCHEMA_CLASSIFICATION, PRODUCT_CODE_KEY, product_codes)
+    pmas = bulk_fetch_records(SCHEMA_PMA, PRODUCT_CODE_KEY, product_codes)
+    recalls = bulk_fetch_records(SCHEMA_RECALL, RECALL_K_NUMBERS_KEY, k_numbers)
+
+    return join_related_records(devices_info,
+                                build_hash_index(classifications, PRODUCT_CODE_KEY),
+                                build_hash_index(pmas, PRODUCT_CODE_KEY),
+                                build_hash_index(recalls, RECALL_K_NUMBERS_KEY))
+
+
+def hash_record(record):
+    # Only hash the 510(k) attributes, so that enriching the records, or a new recall, does not make every record look
+    # updated. Serialize them the same way every time so that equal records always have equal hashes.
+    attributes = {key: record.get(key, EMPTY_STR) for key in SCHEMA_510k.record_keys}
+    record_str = json.dumps(attributes, sort_keys=True, default=str)
+    return hashlib.sha256(record_str.encode()).hexdigest()[:SNAPSHOT_HASH_LENGTH]
+
+
+def build_snapshot(devices_info):
+    # Store each record's decision date next to its hash, so that a later run over a different date range can tell
+    # records outside its range apart from removed records
+    return {info[K_NUMBER_KEY]: [hash_record(info), info[DECISION_DATE_KEY]] for info in devices_info}
+
+
+def is_in_date_range(date_str, from_date_str, to_date_str):
+    # ISO dates sort the same way as strings and as dates
+    return from_date_str <= date_str <= to_date_str
+
+
+def get_snapshot_codec():
+    # Prefer the fastest codec that is installed; gzip is always available
+    if zstandard:
+        return ZSTD_CODEC
+    if lz4:
+        return LZ4_CODEC
+    return GZIP_CODEC
+
+
+def compress_bytes(data):
+    codec = get_snapshot_codec()
+    if codec == ZSTD_CODEC:
+        return zstandard.ZstdCompressor(level=ZSTD_COMPRESSION_LEVEL).compress(data)
+    if codec == LZ4_CODEC:
+        return lz4.frame.compress(data)
+    return gzip.compress(data, compresslevel=GZIP_COMPRESSION_LEVEL)
+
+
+def decompress_bytes(data):
+    # Detect the codec from the magic bytes, so that data written with any codec can be read back. Data without
+    # magic bytes was stored uncompressed.
+    if data.startswith(ZSTD_MAGIC_BYTES):
+        if not zstandard:
+            raise ValueError("The data is compressed with zstd, but zstandard is not installed.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if data.startswith(LZ4_MAGIC_BYTES):
+        if not lz4:
+            raise ValueError("The data is compressed with lz4, but lz4 is not installed.")
+        return lz4.frame.decompress(data)
+    if data.startswith(GZIP_MAGIC_BYTES):
+        return gzip.decompress(data)
+    return data
+
+
+def load_snapshot(snapshot_file_path):
+    # The first run has nothing to compare against, so every record is treated as inserted
+    if not os.path.exists(snapshot_file_path):
+        return {}
+    with open(snapshot_file_path, "rb") as snapshot_file:
+        compressed_bytes = snapshot_file.read()
+
+    # Decompress the snapshot, and record how long that took
+    start_time = time.process_time()
+    snapshot_bytes = decompress_bytes(compressed_bytes)
+    compression_stats.add_loaded(time.process_time() - start_time)
+    snapshot_file_dict = json.loads(snapshot_bytes)
+
+    # Older snapshots stored entries in a different format, which cannot be compared against
+    if not isinstance(snapshot_file_dict, dict) or snapshot_file_dict.get(SNAPSHOT_VERSION_KEY) != SNAPSHOT_VERSION:
+        raise ValueError(f"The snapshot file '{snapshot_file_path}' was written in an older format. Delete it, or use "
+                         f"a new snapshot file, to start a new snapshot.")
+    return snapshot_file_dict[SNAPSHOT_ENTRIES_KEY]
+
+
+def save_snapshot(snapshot, snapshot_file_path):
+    snapshot_file_dict = {SNAPSHOT_VERSION_KEY: SNAPSHOT_VERSION, SNAPSHOT_ENTRIES_KEY: snapshot}
+    snapshot_bytes = json.dumps(snapshot_file_dict, separators=(",", ":"), sort_keys=True).encode()
+
+    # Compress the snapshot, and record how much space that saved and how long it took
+    start_time = time.process_time()
+    compressed_bytes = compress_bytes(snapshot_bytes)
+    compression_stats.add_stored(len(snapshot_bytes), len(compressed_bytes), time.process_time() - start_time)
+
+    with open(snapshot_file_path, "wb") as snapshot_file:
+        snapshot_file.write(compressed_bytes)
+
+
+def get_change_set(devices_info, previous_snapshot, from_date_str, to_date_str):
+    change_set = []
+    current_k_numbers = set()
+
+    # Records whose k_number is new were inserted, and records whose hash differs were updated
+    for info in devices_info:
+        k_number = info[K_NUMBER_KEY]
+        current_k_numbers.add(k_number)
+
+        previous_entry = previous_snapshot.get(k_number)
+        if previous_entry is None:
+            change_type = CHANGE_TYPE_INSERTED
+        elif previous_entry[0] != hash_record(info):
+            change_type = CHANGE_TYPE_UPDATED
+        else:
+            continue
+        change_set.append({CHANGE_TYPE_KEY: change_type, **info})
+
+    # A record is only removed if this run queried its decision date but did not get it back. Only the hash and the
+    # decision date of a removed record are kept, so its other columns are left empty so that every row of the change
+    # set has the same columns.
+    col_headers = list(change_set[0].keys()) if change_set else [CHANGE_TYPE_KEY, K_NUMBER_KEY, DECISION_DATE_KEY]
+    for k_number, (_, decision_date) in sorted(previous_snapshot.items()):
+        if k_number in current_k_numbers or not is_in_date_range(decision_date, from_date_str, to_date_str):
+            continue
+        removed = {col_header: EMPTY_STR for col_header in col_headers}
+        removed[CHANGE_TYPE_KEY] = CHANGE_TYPE_REMOVED
+        removed[K_NUMBER_KEY] = k_number
+        removed[DECISION_DATE_KEY] = decision_date
+        change_set.append(removed)
+
+    return change_set
+
+
+def merge_snapshot(devices_info, previous_snapshot, from_date_str, to_date_str):
+    # Keep the previous entries outside this run's date range, since this run says nothing about them
+    snapshot = {k_number: entry for k_number, entry in previous_snapshot.items()
+                if not is_in_date_range(entry[1], from_date_str, to_date_str)}
+    snapshot.update(build_snapshot(devices_info))
+    return snapshot
+
+
+def get_snapshot_update(devices_info, snapshot_file_path, from_date_str, to_date_str):
+    # Compare the records against the previous run. The new snapshot is returned rather than saved, so that it can be
+    # saved once the change set has been written.
+    previous_snapshot = load_snapshot(snapshot_file_path)
+    change_set = get_change_set(devices_info, previous_snapshot, from_date_str, to_date_str)
+    return change_set, merge_snapshot(devices_info, previous_snapshot, from_date_str, to_date_str)
+
+
 def validate_date(a_date_str):
     # Try to parse the date string
     try:
@@ -178,7 +662,19 @@ def validate_excel_file(excel_file_path):
     return excel_file_path.endswith(EXCEL_FILE_FORMAT)
 
 
-def validate_input(from_decision_date_str, to_decision_date_str, excel_file_path):
+def validate_csv_file(csv_file_path):
+    return csv_file_path.endswith(CSV_FILE_FORMAT)
+
+
+def validate_output_file(output_file_path):
+    return validate_excel_file(output_file_path) or validate_csv_file(output_file_path)
+
+
+def validate_snapshot_file(snapshot_file_path):
+    return snapshot_file_path.endswith(SNAPSHOT_FILE_FORMAT)
+
+
+def validate_input(from_decision_date_str, to_decision_date_str, output_file_path, snapshot_file_path=EMPTY_STR):
     # Use the global query status label to let the user know which inputs they may have entered incorrectly
     global query_status_lbl
 
@@ -196,19 +692,27 @@ def validate_input(from_decision_date_str, to_decision_date_str, excel_file_path
         update_query_status_lbl(INVALID_DATE_RANGE_MSG)
         return False
 
-    # Validate the format of the Excel file: it must end with a .xlsx
-    if not validate_excel_file(excel_file_path):
-        update_query_status_lbl(INVALID_EXCEL_FILE_PATH_MSG)
+    # Validate the format of the results file: it must end with a .xlsx or a .csv
+    if not validate_output_file(output_file_path):
+        update_query_status_lbl(INVALID_OUTPUT_FILE_PATH_MSG)
+        return False
+
+    # The snapshot file is optional, but if given, it must end with a .snapshot
+    if snapshot_file_path and not validate_snapshot_file(snapshot_file_path):
+        update_query_status_lbl(INVALID_SNAPSHOT_FILE_PATH_MSG)
         return False
 
     # At this point, all inputs have been validated as correct
     return True
 
 
-def run_query(to_decision_date, from_decision_date, excel_file_path):
+def run_query(to_decision_date, from_decision_date, output_file_path, enrich_records=False, snapshot_file_path=None):
     # Store the device info in a list
     devices_info = []
 
+    # Only report the compression of this query
+    compression_stats.reset()
+
     # Set the current date from which to make GET requests
     current_date = datetime.datetime.strptime(to_decision_date,
                                               DATE_STR_TO_DATE_TIME_FORMAT)  # Convert date str to datetime
@@ -224,54 +728,75 @@ def run_query(to_decision_date, from_decision_date, excel_file_path):
         search_query_str = query_builder.add_first_query_field(DECISION_DATE_KEY, iso_formatted_date) \
             .get_search_query_string()
 
-        # Set the query params
-        params = {
-            "search": search_query_str,
-            "limit": MAX_QUERY_SIZE,
-        }
-
-        # Re-construct the GET url
-        # Convert the "params" to a string for the GET request
-        # This is done because the requests module converts square brackets [] into percent encodings, which
-        # the openFDA API does not understand.
-        params_str = get_string_from_params(params)
-
-        # Construct the GET url
-        get_url = BASE_URL_510k + "?" + params_str
-
-        # Make the GET request
-        response = requests.get(get_url)
-
-        # If the GET request was successful, extract the desired info from each device entry
-        records = []
-        if response.status_code == 200:
-            records = extract_device_records_from_response(response)
-
-            # Add the devices to our list
-            devices_info.extend(records)
+        # Get every device record with this decision date, and add the devices to our list
+        records = fetch_records(SCHEMA_510k, search_query_str)
+        devices_info.extend(records)
 
         # Go back one calendar day by re-assigning the current date
         current_date = get_previous_day_from_datetime(current_date)
         iso_formatted_date = datetime.date.isoformat(current_date)
 
+    # Add the classification, PMA, and recall data for the devices
+    if enrich_records and devices_info:
+        enrich_device_records(devices_info)
+
     # If we're using the GUI, then this method will have been started as a thread. As a result, we need to call the
-    # method below to start the next thread to save data to the workbook
+    # method below to start the next thread to save data to the workbook. In snapshot mode, that thread saves only the
+    # records that changed since the last run.
     if USING_GUI:
-        handle_run_query(devices_info, excel_file_path)
+        handle_run_query(devices_info, output_file_path, snapshot_file_path, from_decision_date, to_decision_date)
+    else:
+        logger.info(compression_stats.get_report())
 
     return devices_info
 
 
-def save_devices_info_to_excel_file(devices_info, excel_file):
+def save_devices_info_to_file(devices_info, output_file_path, snapshot_file_path=None, from_decision_date=None,
+                              to_decision_date=None):
     global run_query_btn
 
+    # In snapshot mode, only the records that changed within the queried date range since the last run are saved
+    snapshot = None
+    if snapshot_file_path:
+        if not from_decision_date or not to_decision_date:
+            raise ValueError("The queried date range is needed to compare the records against a snapshot.")
+        devices_info, snapshot = get_snapshot_update(devices_info, snapshot_file_path, from_decision_date,
+                                                     to_decision_date)
+
+    # Write the results in the format that the file's extension asks for
+    if validate_csv_file(output_file_path):
+        save_devices_info_to_csv_file(devices_info, output_file_path)
+    else:
+        save_devices_info_to_excel_file(devices_info, output_file_path)
+
+    # The change set has been written, so the next run can compare against this run. Saving the snapshot any earlier
+    # would lose the change set for good if the write failed.
+    if snapshot_file_path:
+        save_snapshot(snapshot, snapshot_file_path)
+
+    # If using the GUI, then update the GUI:
+    if USING_GUI:
+        # Notify the user that the results are available
+        update_query_status_lbl(QUERY_STATUS_FINISHED_TEXT + ". " + compression_stats.get_report())
+
+        # Enable the query button again
+        run_query_btn.config(state=tkinter.ACTIVE)
+    else:
+        logger.info(compression_stats.get_report())
+
+    return devices_info
+
+
+def save_devices_info_to_excel_file(devices_info, excel_file):
     # Create an Excel workbook and worksheet
     workbook = openpyxl.Workbook()
     worksheet = workbook.create_sheet(EXCEL_SHEET_NAME)
 
-    # Write the column labels to the worksheet
-    col_headers = list(devices_info[0].keys())
-    worksheet.append(col_headers)
+    # Write the column labels to the worksheet. There may be no records, e.g. if nothing changed since the last
+    # snapshot.
+    if devices_info:
+        col_headers = list(devices_info[0].keys())
+        worksheet.append(col_headers)
 
     # Write the device records to each row in the worksheet
     for info in devices_info:
@@ -279,55 +804,73 @@ def save_devices_info_to_excel_file(devices_info, excel_file):
 
     workbook.save(excel_file)
 
-    # If using the GUI, then update the GUI:
-    if USING_GUI:
-        # Notify the user that the workbook is available
-        update_query_status_lbl(QUERY_STATUS_FINISHED_TEXT)
 
-        # Enable the query button again
-        run_query_btn.config(state=tkinter.ACTIVE)
+def save_devices_info_to_csv_file(devices_info, csv_file):
+    with open(csv_file, "w", newline=EMPTY_STR) as csv_file_obj:
+        writer = csv.writer(csv_file_obj)
+
+        # Write the column labels, then the device records to each row
+        if devices_info:
+            writer.writerow(list(devices_info[0].keys()))
+        for info in devices_info:
+            writer.writerow(list(info.values()))
 
 
 def handle_left_mouse_button_click():
     global to_decision_date_ent
     global from_decision_date_ent
     global excel_file_ent
+    global snapshot_file_ent
     global run_query_btn
+    global enrich_records_var
 
-    # Get the start date, end date, and excel file that the user provided
+    # Get the start date, end date, and results file that the user provided
     to_decision_date_str = to_decision_date_ent.get()
     from_decision_date_str = from_decision_date_ent.get()
-    excel_file_path = excel_file_ent.get()
+    output_file_path = excel_file_ent.get()
+    enrich_records = enrich_records_var.get()
+    snapshot_file_path = snapshot_file_ent.get()
 
     # Validate the user's input
-    valid_input = validate_input(from_decision_date_str, to_decision_date_str, excel_file_path)
+    valid_input = validate_input(from_decision_date_str, to_decision_date_str, output_file_path, snapshot_file_path)
     if not valid_input:
         return
 
     # Disable the button until the query is finished
     run_query_btn.config(state=tkinter.DISABLED)
 
-    # Create a separate thread to run the query
-    run_query_thread = threading.Thread(target=run_query, args=(to_decision_date_str, from_decision_date_str,
-                                                                excel_file_path))
-    # Make this thread a daemon so that it is killed automatically when the main thread exits
-    run_query_thread.daemon = True
-
     # Update the query status label
     update_query_status_lbl(QUERY_STATUS_RUNNING_TEXT)
 
-    # Run the thread
-    run_query_thread.start()
+    # Run the query in a separate thread
+    start_gui_thread(run_query, (to_decision_date_str, from_decision_date_str, output_file_path, enrich_records,
+                                 snapshot_file_path))
 
 
-def handle_run_query(devices_info, excel_file_path):
+def handle_run_query(devices_info, output_file_path, snapshot_file_path, from_decision_date, to_decision_date):
     # Create a thread to save the device info
-    save_devices_info_thread = threading.Thread(target=save_devices_info_to_excel_file,
-                                                args=(devices_info, excel_file_path))
+    start_gui_thread(save_devices_info_to_file, (devices_info, output_file_path, snapshot_file_path,
+                                                 from_decision_date, to_decision_date))
+
+
+def run_gui_thread_target(target, args):
+    global run_query_btn
+
+    # An error would otherwise end the thread silently and leave the query button disabled
+    try:
+        target(*args)
+    except Exception as error:
+        update_query_status_lbl(QUERY_STATUS_FAILED_TEXT + str(error))
+        run_query_btn.config(state=tkinter.ACTIVE)
+
+
+def start_gui_thread(target, args):
+    thread = threading.Thread(target=run_gui_thread_target, args=(target, args))
+
     # Make this thread a daemon so that it is killed automatically when the main thread exits
-    save_devices_info_thread.daemon = True
+    thread.daemon = True
 
-    save_devices_info_thread.start()
+    thread.start()
 
 
 def handle_window_close():
@@ -354,8 +897,10 @@ def main():
     global to_decision_date_ent
     global from_decision_date_ent
     global excel_file_ent
+    global snapshot_file_ent
     global query_status_lbl
     global run_query_btn
+    global enrich_records_var
 
     # Use the global window
     global window
@@ -381,13 +926,25 @@ def main():
     to_decision_date_ent = tkinter.Entry()
     to_decision_date_ent.pack()
 
-    # Similar to above: create a label for the Excel file path and an entry, and add them to the window
+    # Similar to above: create a label for the results file path and an entry, and add them to the window
     excel_file_path_lbl = tkinter.Label(text=EXCEL_FILE_LBL_TEXT)
     excel_file_path_lbl.pack()
 
     excel_file_ent = tkinter.Entry()
     excel_file_ent.pack()
 
+    # Similar to above, but for the optional snapshot file
+    snapshot_file_path_lbl = tkinter.Label(text=SNAPSHOT_FILE_LBL_TEXT)
+    snapshot_file_path_lbl.pack()
+
+    snapshot_file_ent = tkinter.Entry()
+    snapshot_file_ent.pack()
+
+    # Create a check box that the user can tick to add related classification, PMA, and recall data to the results
+    enrich_records_var = tkinter.BooleanVar()
+    enrich_records_chk = tkinter.Checkbutton(text=ENRICH_RECORDS_CHK_TEXT, variable=enrich_records_var)
+    enrich_records_chk.pack()
+
     # Create a button that the user can click to run the query and make it listen for mouse clicks
     run_query_btn = tkinter.Button(text=RUN_QUERY_BTN_TEXT, command=handle_left_mouse_button_click)
 
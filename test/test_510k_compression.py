@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for compressed transfer and compressed storage in the openFDA 510(k) API script
+"""
+
+import unittest
+from unittest import mock
+import gzip
+import json
+
+from src import fda_510k_api
+
+
+class FakeRaw:
+    def __init__(self, wire_bytes):
+        self.wire_bytes = wire_bytes
+
+    def tell(self):
+        return self.wire_bytes
+
+
+class FakeRequest:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class FakeResponse:
+    def __init__(self, content, wire_bytes, headers, request_headers):
+        self.content = content
+        self.raw = FakeRaw(wire_bytes)
+        self.headers = headers
+        self.request = FakeRequest(request_headers)
+
+
+class Test510kCompression(unittest.TestCase):
+    def setUp(self):
+        # Build the data the way a real snapshot is built, so that it holds high-entropy hashes
+        devices_info = [{fda_510k_api.K_NUMBER_KEY: "K19%04d" % i, fda_510k_api.DECISION_DATE_KEY: "2019-12-08",
+                         fda_510k_api.DEVICE_NAME_KEY: "Device %d" % i} for i in range(1000)]
+        self.data = json.dumps(fda_510k_api.build_snapshot(devices_info), separators=(",", ":")).encode()
+
+    def test_compress_bytes(self):
+        compressed = fda_510k_api.compress_bytes(self.data)
+        self.assertLess(len(compressed), len(self.data))
+        self.assertEqual(self.data, fda_510k_api.decompress_bytes(compressed))
+
+    def test_decompress_bytes_gzip(self):
+        # gzip data can always be read back, whichever codec is preferred
+        self.assertEqual(self.data, fda_510k_api.decompress_bytes(gzip.compress(self.data)))
+
+    def test_decompress_bytes_uncompressed(self):
+        self.assertEqual(self.data, fda_510k_api.decompress_bytes(self.data))
+
+    def test_compression_stats(self):
+        stats = fda_510k_api.CompressionStats()
+
+        # One compressed response, and two uncompressed responses of which only one asked for compression
+        accept_encoding = {fda_510k_api.ACCEPT_ENCODING_HEADER: "gzip, deflate"}
+        stats.add_response(FakeResponse(self.data, 100, {fda_510k_api.CONTENT_ENCODING_HEADER: "gzip"},
+                                        accept_encoding), 0.25)
+        stats.add_response(FakeResponse(self.data, len(self.data), {}, accept_encoding), 0.0)
+        stats.add_response(FakeResponse(self.data, len(self.data), {}, {}), 0.0)
+        stats.add_stored(1000, 200, 0.5)
+        stats.add_loaded(0.125)
+
+        self.assertEqual(100 + 2 * len(self.data), stats.wire_bytes)
+        self.assertEqual(3 * len(self.data), stats.decoded_bytes)
+        self.assertEqual({"gzip": 1, fda_510k_api.IDENTITY_ENCODING: 2}, stats.response_encodings)
+        self.assertEqual(1, stats.uncompressed_responses)
+        self.assertIn("not compressed even though compression was negotiated: 1", stats.get_report())
+        self.assertEqual(1000, stats.raw_stored_bytes)
+        self.assertEqual(200, stats.stored_bytes)
+        self.assertEqual(0.25, stats.decode_cpu_seconds)
+        self.assertEqual(0.625, stats.codec_cpu_seconds)
+
+        # Resetting clears everything
+        stats.reset()
+        self.assertEqual(0, stats.wire_bytes)
+        self.assertEqual({}, stats.response_encodings)
+        self.assertEqual(0, stats.uncompressed_responses)
+
+    def test_run_query_logs_report(self):
+        # Without the GUI, the compression report is logged so that headless runs still see it
+        with mock.patch.object(fda_510k_api, "fetch_records", return_value=[]):
+            with self.assertLogs(fda_510k_api.logger, "INFO") as logs:
+                fda_510k_api.run_query("2019-12-08", "2019-12-08", "book.xlsx")
+
+        self.assertEqual(1, len(logs.records))
+        self.assertIn("Downloaded", logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for extracting records from the openFDA device endpoints and joining them to 510(k) records
+"""
+
+import unittest
+from unittest import mock
+
+from src import fda_510k_api
+
+
+class FakeResponse:
+    def __init__(self, json_dict, status_code=200):
+        self.json_dict = json_dict
+        self.status_code = status_code
+
+    def json(self):
+        return self.json_dict
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise fda_510k_api.requests.HTTPError(f"{self.status_code} Error")
+
+
+def get_page_response(first_k_number, page_size, total):
+    # Build a page of 510(k) records numbered from first_k_number, as openFDA would return them
+    results = [{fda_510k_api.K_NUMBER_KEY: "K%06d" % i} for i in range(first_k_number,
+                                                                        min(first_k_number + page_size, total))]
+    return FakeResponse({
+        fda_510k_api.META_DICT_KEY: {fda_510k_api.RESULTS_DICT_KEY: {fda_510k_api.TOTAL_DICT_KEY: total}},
+        fda_510k_api.RESULTS_DICT_KEY: results,
+    })
+
+
+def get_skip_from_url(url):
+    return int(url.split(fda_510k_api.SKIP_QUERY_KEY + fda_510k_api.EQUALS_STR)[1])
+
+
+class Test510kEnrichment(unittest.TestCase):
+    def test_extract_records_from_response(self):
+        # The schema's attributes are kept; attributes that are not in the schema are dropped
+        response = FakeResponse({
+            fda_510k_api.RESULTS_DICT_KEY: [
+                {"product_code": "QAS", "device_class": "2", "review_panel": "RA"},
+            ]
+        })
+        records = fda_510k_api.extract_records_from_response(response, fda_510k_api.SCHEMA_CLASSIFICATION)
+
+        self.assertEqual(1, len(records))
+        self.assertEqual(fda_510k_api.SCHEMA_CLASSIFICATION.record_keys, list(records[0].keys()))
+        self.assertEqual("QAS", records[0][fda_510k_api.PRODUCT_CODE_KEY])
+        self.assertEqual("2", records[0][fda_510k_api.DEVICE_CLASS_KEY])
+
+        # Attributes that are missing from a record are empty
+        self.assertEqual(fda_510k_api.EMPTY_STR, records[0][fda_510k_api.REGULATION_NUMBER_KEY])
+
+    def test_build_search_query_for_values(self):
+        expected = "product_code:QAS+product_code:LLZ"
+        self.assertEqual(expected, fda_510k_api.build_search_query_for_values("product_code", ["QAS", "LLZ"]))
+
+    def test_build_hash_index(self):
+        records = [
+            {"k_numbers": ["K190273", "K192279"], "res_event_number": "1"},
+            {"k_numbers": ["K190273"], "res_event_number": "2"},
+            {"k_numbers": fda_510k_api.EMPTY_STR, "res_event_number": "3"},
+        ]
+        index = fda_510k_api.build_hash_index(records, "k_numbers")
+
+        # Records with a list of values are indexed under each value, and records without a value are left out
+        self.assertEqual([records[0], records[1]], index["K190273"])
+        self.assertEqual([records[0]], index["K192279"])
+        self.assertEqual(2, len(index))
+
+    def test_join_related_records(self):
+        devices_info = [
+            {fda_510k_api.K_NUMBER_KEY: "K190273", fda_510k_api.PRODUCT_CODE_KEY: "QAS"},
+            {fda_510k_api.K_NUMBER_KEY: "K192279", fda_510k_api.PRODUCT_CODE_KEY: "LLZ"},
+        ]
+        classifications = [
+            {fda_510k_api.PRODUCT_CODE_KEY: "QAS", fda_510k_api.DEVICE_CLASS_KEY: "2",
+             fda_510k_api.REGULATION_NUMBER_KEY: "870.2200", fda_510k_api.MEDICAL_SPECIALTY_KEY: "Cardiovascular"},
+        ]
+        pmas = [
+            {fda_510k_api.PRODUCT_CODE_KEY: "QAS", fda_510k_api.PMA_NUMBER_KEY: "P100001"},
+            {fda_510k_api.PRODUCT_CODE_KEY: "QAS", fda_510k_api.PMA_NUMBER_KEY: "P100001"},
+            {fda_510k_api.PRODUCT_CODE_KEY: "QAS", fda_510k_api.PMA_NUMBER_KEY: "P100002"},
+        ]
+        recalls = [
+            {fda_510k_api.RECALL_K_NUMBERS_KEY: ["K192279"], fda_510k_api.RECALL_EVENT_NUMBER_KEY: "80001"},
+        ]
+
+        fda_510k_api.join_related_records(devices_info,
+                                          fda_510k_api.build_hash_index(classifications, "product_code"),
+                                          fda_510k_api.build_hash_index(pmas, "product_code"),
+                                          fda_510k_api.build_hash_index(recalls, "k_numbers"))
+
+        # Verify the first record, which has a classification and PMAs but no recalls
+        self.assertEqual("2", devices_info[0][fda_510k_api.DEVICE_CLASS_KEY])
+        self.assertEqual("870.2200", devices_info[0][fda_510k_api.REGULATION_NUMBER_KEY])
+        self.assertEqual("P100001, P100002", devices_info[0][fda_510k_api.PMA_NUMBERS_KEY])
+        self.assertEqual(0, devices_info[0][fda_510k_api.RECALL_COUNT_KEY])
+        self.assertEqual(fda_510k_api.EMPTY_STR, devices_info[0][fda_510k_api.RECALL_EVENT_NUMBERS_KEY])
+
+        # Verify the second record, which only has a recall
+        self.assertEqual(fda_510k_api.EMPTY_STR, devices_info[1][fda_510k_api.DEVICE_CLASS_KEY])
+        self.assertEqual(fda_510k_api.EMPTY_STR, devices_info[1][fda_510k_api.PMA_NUMBERS_KEY])
+        self.assertEqual(1, devices_info[1][fda_510k_api.RECALL_COUNT_KEY])
+        self.assertEqual("80001", devices_info[1][fda_510k_api.RECALL_EVENT_NUMBERS_KEY])
+
+    def test_fetch_records_pages(self):
+        urls = []
+
+        def get_response(url):
+            urls.append(url)
+            return get_page_response(get_skip_from_url(url), 100, 250)
+
+        with mock.patch.object(fda_510k_api, "get_response", get_response):
+            records = fda_510k_api.fetch_records(fda_510k_api.SCHEMA_510k, "decision_date:2019-12-08", 100)
+
+        # Every record is retrieved, a page at a time, and no page is requested past the total
+        self.assertEqual([0, 100, 200], [get_skip_from_url(url) for url in urls])
+        self.assertEqual(250, len(records))
+        self.assertEqual("K000249", records[-1][fda_510k_api.K_NUMBER_KEY])
+
+    def test_fetch_records_empty_page(self):
+        urls = []
+
+        def get_response(url):
+            urls.append(url)
+            skip = get_skip_from_url(url)
+
+            # The second page is empty, even though the total says there are more records
+            return get_page_response(skip, 0 if skip else 100, 500)
+
+        with mock.patch.object(fda_510k_api, "get_response", get_response):
+            records = fda_510k_api.fetch_records(fda_510k_api.SCHEMA_510k, "decision_date:2019-12-08", 100)
+
+        self.assertEqual(2, len(urls))
+        self.assertEqual(100, len(records))
+
+    def test_fetch_records_no_matches(self):
+        urls = []
+
+        def get_response(url):
+            urls.append(url)
+            return FakeResponse({}, 404)
+
+        with mock.patch.object(fda_510k_api, "get_response", get_response):
+            records = fda_510k_api.fetch_records(fda_510k_api.SCHEMA_510k, "decision_date:2019-12-08")
+
+        self.assertEqual(1, len(urls))
+        self.assertEqual([], records)
+
+    def test_fetch_records_error(self):
+        def get_response(url):
+            # openFDA is rate limiting us
+            return FakeResponse({}, 429)
+
+        # Any error other than "no matches" is raised, so that a partial fetch is never mistaken for a complete one
+        with mock.patch.object(fda_510k_api, "get_response", get_response):
+            with self.assertRaises(fda_510k_api.requests.HTTPError):
+                fda_510k_api.fetch_records(fda_510k_api.SCHEMA_510k, "decision_date:2019-12-08")
+
+    def test_fetch_records_too_large(self):
+        def get_response(url):
+            return get_page_response(0, 100, fda_510k_api.MAX_QUERY_SKIP + 101)
+
+        # Paging could not retrieve every record, so the fetch fails instead of returning only some of them
+        with mock.patch.object(fda_510k_api, "get_response", get_response):
+            with self.assertRaises(fda_510k_api.QueryTooLargeError):
+                fda_510k_api.fetch_records(fda_510k_api.SCHEMA_510k, "decision_date:2019-12-08", 100)
+
+    def test_bulk_fetch_records_chunks(self):
+        urls = []
+
+        def get_response(url):
+            urls.append(url)
+            return get_page_response(0, 1, 1)
+
+        k_numbers = ["K%06d" % i for i in range(120)]
+        with mock.patch.object(fda_510k_api, "get_response", get_response):
+            fda_510k_api.bulk_fetch_records(fda_510k_api.SCHEMA_RECALL, "k_numbers", k_numbers, 50)
+
+        # 120 values are searched in chunks of 50, 50, and 20, each chunk's values OR'd together
+        self.assertEqual(3, len(urls))
+        self.assertEqual([50, 50, 20], [url.count("k_numbers:") for url in urls])
+
+    def test_bulk_fetch_records_splits_large_chunk(self):
+        urls = []
+
+        def get_response(url):
+            urls.append(url)
+
+            # A search for more than one value matches too many records to page through
+            num_values = url.count("k_numbers:")
+            total = fda_510k_api.MAX_QUERY_SKIP + fda_510k_api.MAX_BULK_QUERY_SIZE + 1 if num_values > 1 else 1
+            return get_page_response(0, 1, total)
+
+        k_numbers = ["K000001", "K000002", "K000003"]
+        with mock.patch.object(fda_510k_api, "get_response", get_response):
+            records = fda_510k_api.bulk_fetch_records(fda_510k_api.SCHEMA_RECALL, "k_numbers", k_numbers)
+
+        # The chunk is split in half until each search can be paged through: [1, 2, 3] -> [1], [2, 3] -> [2], [3]
+        self.assertEqual([3, 1, 2, 1, 1], [url.count("k_numbers:") for url in urls])
+        self.assertEqual(3, len(records))
+
+
+if __name__ == '__main__':
+    unittest.main()
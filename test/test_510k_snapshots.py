@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for snapshots of 510(k) records and the change sets between them
+"""
+
+import unittest
+import csv
+import json
+import os
+
+from src import fda_510k_api
+
+FROM_DATE = "2019-12-07"
+TO_DATE = "2019-12-08"
+
+
+class Test510kSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.first_record = {fda_510k_api.K_NUMBER_KEY: "K190273", fda_510k_api.DECISION_DATE_KEY: "2019-12-08",
+                             fda_510k_api.DEVICE_NAME_KEY: "T3 Platform software"}
+        self.second_record = {fda_510k_api.K_NUMBER_KEY: "K192279", fda_510k_api.DECISION_DATE_KEY: "2019-12-07",
+                              fda_510k_api.DEVICE_NAME_KEY: "PhantomMSK Trauma"}
+
+    def test_hash_record(self):
+        # Equal records have equal hashes, regardless of the order of their attributes
+        reordered_record = dict(reversed(list(self.first_record.items())))
+        self.assertEqual(fda_510k_api.hash_record(self.first_record), fda_510k_api.hash_record(reordered_record))
+        self.assertEqual(fda_510k_api.SNAPSHOT_HASH_LENGTH, len(fda_510k_api.hash_record(self.first_record)))
+
+        # Different records have different hashes
+        self.assertNotEqual(fda_510k_api.hash_record(self.first_record),
+                            fda_510k_api.hash_record(self.second_record))
+
+    def test_build_snapshot(self):
+        # Each record's hash is stored along with its decision date
+        snapshot = fda_510k_api.build_snapshot([self.first_record])
+        expected_snapshot = {"K190273": [fda_510k_api.hash_record(self.first_record), "2019-12-08"]}
+        self.assertEqual(expected_snapshot, snapshot)
+
+    def test_get_change_set_no_previous_snapshot(self):
+        # Every record is inserted on the first run
+        change_set = fda_510k_api.get_change_set([self.first_record, self.second_record], {}, FROM_DATE, TO_DATE)
+
+        self.assertEqual(2, len(change_set))
+        self.assertEqual(fda_510k_api.CHANGE_TYPE_INSERTED, change_set[0][fda_510k_api.CHANGE_TYPE_KEY])
+        self.assertEqual(fda_510k_api.CHANGE_TYPE_INSERTED, change_set[1][fda_510k_api.CHANGE_TYPE_KEY])
+
+    def test_get_change_set(self):
+        previous_snapshot = fda_510k_api.build_snapshot([self.first_record, self.second_record])
+
+        # Update the first record, remove the second record, and insert a third record
+        updated_record = dict(self.first_record)
+        updated_record[fda_510k_api.DEVICE_NAME_KEY] = "T3 Platform software v2"
+        inserted_record = {fda_510k_api.K_NUMBER_KEY: "K193001", fda_510k_api.DECISION_DATE_KEY: "2019-12-08",
+                           fda_510k_api.DEVICE_NAME_KEY: "New device"}
+
+        change_set = fda_510k_api.get_change_set([updated_record, inserted_record], previous_snapshot, FROM_DATE,
+                                                 TO_DATE)
+
+        expected_change_set = [
+            {fda_510k_api.CHANGE_TYPE_KEY: fda_510k_api.CHANGE_TYPE_UPDATED, **updated_record},
+            {fda_510k_api.CHANGE_TYPE_KEY: fda_510k_api.CHANGE_TYPE_INSERTED, **inserted_record},
+            {fda_510k_api.CHANGE_TYPE_KEY: fda_510k_api.CHANGE_TYPE_REMOVED, fda_510k_api.K_NUMBER_KEY: "K192279",
+             fda_510k_api.DECISION_DATE_KEY: "2019-12-07", fda_510k_api.DEVICE_NAME_KEY: fda_510k_api.EMPTY_STR},
+        ]
+        self.assertEqual(expected_change_set, change_set)
+
+        # Every row of the change set has the same columns, in the same order
+        for change in change_set:
+            self.assertEqual(list(change_set[0].keys()), list(change.keys()))
+
+    def test_get_change_set_unchanged(self):
+        previous_snapshot = fda_510k_api.build_snapshot([self.first_record, self.second_record])
+        self.assertEqual([], fda_510k_api.get_change_set([self.first_record, self.second_record], previous_snapshot,
+                                                         FROM_DATE, TO_DATE))
+
+    def test_get_change_set_other_date_range(self):
+        previous_snapshot = fda_510k_api.build_snapshot([self.first_record, self.second_record])
+
+        # A run over only the later day does not get the second record back, but did not query its decision date,
+        # so the second record is not removed
+        change_set = fda_510k_api.get_change_set([self.first_record], previous_snapshot, TO_DATE, TO_DATE)
+        self.assertEqual([], change_set)
+
+        # The second record is kept in the new snapshot for runs that do query its decision date
+        snapshot = fda_510k_api.merge_snapshot([self.first_record], previous_snapshot, TO_DATE, TO_DATE)
+        self.assertEqual(previous_snapshot, snapshot)
+
+    def test_save_devices_info_to_file(self):
+        output_file_path = "test_change_set.csv"
+        snapshot_file_path = "test_snapshot.snapshot"
+        devices_info = [self.first_record, self.second_record]
+
+        # The first run inserts every record, and saves the snapshot once the change set has been written
+        change_set = fda_510k_api.save_devices_info_to_file(devices_info, output_file_path, snapshot_file_path,
+                                                            FROM_DATE, TO_DATE)
+        self.assertEqual(2, len(change_set))
+        self.assertEqual(fda_510k_api.build_snapshot(devices_info), fda_510k_api.load_snapshot(snapshot_file_path))
+
+        # The change set was written as a CSV file, because of the file's extension
+        with open(output_file_path, newline=fda_510k_api.EMPTY_STR) as csv_file:
+            csv_rows = list(csv.reader(csv_file))
+        self.assertEqual(list(change_set[0].keys()), csv_rows[0])
+        self.assertEqual([str(value) for value in change_set[1].values()], csv_rows[2])
+
+        # The second run finds nothing changed, and writes no rows
+        change_set = fda_510k_api.save_devices_info_to_file(devices_info, output_file_path, snapshot_file_path,
+                                                            FROM_DATE, TO_DATE)
+        self.assertEqual([], change_set)
+
+        os.remove(output_file_path)
+        os.remove(snapshot_file_path)
+
+    def test_save_devices_info_to_file_failed(self):
+        snapshot_file_path = "test_snapshot.snapshot"
+
+        # The change set cannot be written to a folder that does not exist, so the snapshot must not be saved either
+        with self.assertRaises(OSError):
+            fda_510k_api.save_devices_info_to_file([self.first_record], os.path.join("missing_folder", "changes.csv"),
+                                                   snapshot_file_path, FROM_DATE, TO_DATE)
+        self.assertFalse(os.path.exists(snapshot_file_path))
+
+    def test_hash_record_ignores_enrichment(self):
+        # Enriching a record, or a new recall for it, does not change its 510(k) attributes
+        enriched_record = dict(self.first_record)
+        enriched_record[fda_510k_api.DEVICE_CLASS_KEY] = "2"
+        enriched_record[fda_510k_api.RECALL_COUNT_KEY] = 1
+        self.assertEqual(fda_510k_api.hash_record(self.first_record), fda_510k_api.hash_record(enriched_record))
+
+        previous_snapshot = fda_510k_api.build_snapshot([self.first_record])
+        self.assertEqual([], fda_510k_api.get_change_set([enriched_record], previous_snapshot, TO_DATE, TO_DATE))
+
+    def test_load_snapshot_older_format(self):
+        snapshot_file_path = "test_snapshot.snapshot"
+
+        # Version 1 snapshots stored a bare hash per k_number, with no version
+        with open(snapshot_file_path, "wb") as snapshot_file:
+            snapshot_file.write(fda_510k_api.compress_bytes(json.dumps({"K190273": "0123456789abcdef"}).encode()))
+
+        with self.assertRaisesRegex(ValueError, "older format"):
+            fda_510k_api.load_snapshot(snapshot_file_path)
+
+        os.remove(snapshot_file_path)
+
+    def test_validate_snapshot_file(self):
+        self.assertTrue(fda_510k_api.validate_snapshot_file("snapshot.snapshot"))
+        self.assertFalse(fda_510k_api.validate_snapshot_file("snapshot.xlsx"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -75,6 +75,15 @@ class Test510kUtils(unittest.TestCase):
         invalid_excel_file_path = "valid.xls"  # Missing the last x
         self.assertFalse(fda_510k_api.validate_excel_file(invalid_excel_file_path))
 
+    def test_validate_output_file_valid(self):
+        # Results can be saved to an Excel file or to a CSV file
+        self.assertTrue(fda_510k_api.validate_output_file("valid.xlsx"))
+        self.assertTrue(fda_510k_api.validate_output_file("valid.csv"))
+
+    def test_validate_output_file_invalid(self):
+        invalid_output_file_path = "invalid.txt"
+        self.assertFalse(fda_510k_api.validate_output_file(invalid_output_file_path))
+
     def test_validate_input_invalid_to_date_str(self):
         invalid_to_date_str = ""
         valid_from_date_str = "2020-03-01"